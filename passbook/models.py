@@ -1,14 +1,53 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import dataclasses
+import datetime
 import decimal
+import enum
+import functools
 import hashlib
 import json
+import mmap
+import os
+import uuid
 import zipfile
 from io import BytesIO
 
+from M2Crypto import EVP
 from M2Crypto import SMIME
 from M2Crypto import X509
 from M2Crypto.X509 import X509_Stack
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Size of the chunks used to hash and copy the files included in a pass
+CHUNK_SIZE = 1 << 18
+
+# Size from which files added by path are read from an mmap instead of in
+# chunks. Mapping costs more than reading the usual few KB images, and a
+# mapped file that is truncated while it is read crashes the process.
+MMAP_THRESHOLD = 1 << 22
+
+# Size of the write buffer of the .pkpass files created from a path
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Extensions of the pass files that are already compressed
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Deflate level of the other files, the fastest one shrinks JSON files
+# several times at almost no cost
+COMPRESS_LEVEL = 1
+
+# Date of all the entries of a .pkpass, the earliest a zip file supports
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# The manifest signature is detached and the manifest signed as binary data
+SIGNATURE_FLAGS = SMIME.PKCS7_DETACHED | SMIME.PKCS7_BINARY
+
 
 class Alignment:
     LEFT = 'PKTextAlignmentLeft'
@@ -73,9 +112,6 @@ class DateField(Field):
         if ignoresTimeZone:
             self.ignoresTimeZone = ignoresTimeZone
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class NumberField(Field):
 
@@ -83,9 +119,6 @@ class NumberField(Field):
         super().__init__(key, value, label)
         self.numberStyle = NumberStyle.DECIMAL  # Style of date to display
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class CurrencyField(Field):
 
@@ -93,9 +126,6 @@ class CurrencyField(Field):
         super().__init__(key, value, label)
         self.currencyCode = currencyCode  # ISO 4217 currency code
 
-    def json_dict(self):
-        return self.__dict__
-
 
 class Barcode(object):
 
@@ -152,8 +182,40 @@ class IBeacon(object):
         return self.__dict__
 
 
+def _compile_fields_json_dict(groups):
+    """
+    Generates the method serializing the given field groups of a
+    PassInformation, unrolled into one branch per group. This avoids a
+    getattr call and a loop iteration per group on every serialization.
+    """
+    lines = ['def _fields_json_dict(self):', '    d = {}']
+    for group in groups:
+        if not group.isidentifier():
+            raise ValueError('Invalid field group: %r' % (group,))
+        lines += [
+            '    fields = self.%s' % group,
+            '    if fields:',
+            '        d[%r] = [f.json_dict() for f in fields]' % group,
+        ]
+    lines.append('    return d')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['_fields_json_dict']
+
+
 class PassInformation(object):
 
+    # Field groups, in the order they are serialized
+    _FIELD_GROUPS = ('headerFields', 'primaryFields', 'secondaryFields',
+                     'backFields', 'auxiliaryFields')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Subclasses that change the field groups get them serialized by
+        # json_dict, including the json_dict of a class they inherit from
+        if '_FIELD_GROUPS' in cls.__dict__ and '_fields_json_dict' not in cls.__dict__:
+            cls._fields_json_dict = _compile_fields_json_dict(cls._FIELD_GROUPS)
+
     def __init__(self):
         self.headerFields = []
         self.primaryFields = []
@@ -161,34 +223,31 @@ class PassInformation(object):
         self.backFields = []
         self.auxiliaryFields = []
 
+    def addField(self, group, key, value, label=''):
+        """
+        Adds a field to one of the field groups, e.g. 'headerFields'.
+        """
+        getattr(self, group).append(Field(key, value, label))
+
     def addHeaderField(self, key, value, label):
-        self.headerFields.append(Field(key, value, label))
+        self.addField('headerFields', key, value, label)
 
     def addPrimaryField(self, key, value, label):
-        self.primaryFields.append(Field(key, value, label))
+        self.addField('primaryFields', key, value, label)
 
     def addSecondaryField(self, key, value, label):
-        self.secondaryFields.append(Field(key, value, label))
+        self.addField('secondaryFields', key, value, label)
 
     def addBackField(self, key, value, label):
-        self.backFields.append(Field(key, value, label))
+        self.addField('backFields', key, value, label)
 
     def addAuxiliaryField(self, key, value, label):
-        self.auxiliaryFields.append(Field(key, value, label))
+        self.addField('auxiliaryFields', key, value, label)
+
+    _fields_json_dict = _compile_fields_json_dict(_FIELD_GROUPS)
 
     def json_dict(self):
-        d = {}
-        if self.headerFields:
-            d.update({'headerFields': [f.json_dict() for f in self.headerFields]})
-        if self.primaryFields:
-            d.update({'primaryFields': [f.json_dict() for f in self.primaryFields]})
-        if self.secondaryFields:
-            d.update({'secondaryFields': [f.json_dict() for f in self.secondaryFields]})
-        if self.backFields:
-            d.update({'backFields': [f.json_dict() for f in self.backFields]})
-        if self.auxiliaryFields:
-            d.update({'auxiliaryFields': [f.json_dict() for f in self.auxiliaryFields]})
-        return d
+        return self._fields_json_dict()
 
 
 class BoardingPass(PassInformation):
@@ -298,48 +357,72 @@ class Pass(object):
 
         self.passInformation = passInformation
 
-    # Adds file to the file array
     def addFile(self, name, fd):
-        self._files[name] = fd.read()
+        """
+        Adds a file to the pass. `fd` can be a path or a binary file object.
+        Binary file objects are read right away, so they can be closed once
+        added. Paths are only read when the pass is created: the file is
+        hashed and copied into the .pkpass in chunks, so its contents are
+        never held in memory. Files of MMAP_THRESHOLD bytes or more are
+        memory-mapped; truncating or rewriting them while the pass is created
+        kills the process with SIGBUS instead of raising an exception.
+        """
+        self._files[name] = _FileSource(fd)
+        self._hashes.pop(name, None)
 
     # Creates the actual .pkpass file
     def create(self, certificate, key, wwdr_certificate, password, zip_file=None):
+        # Load the credentials first, so that errors with them don't leave
+        # an incomplete .pkpass behind
+        self._get_smime(certificate, key, wwdr_certificate, password)
         pass_json = self._createPassJson()
-        manifest = self._createManifest(pass_json)
-        signature = self._createSignature(manifest, certificate, key, wwdr_certificate, password)
         if not zip_file:
             zip_file = BytesIO()
-        self._createZip(pass_json, manifest, signature, zip_file=zip_file)
+        self._createZip(pass_json, zip_file, certificate, key, wwdr_certificate, password)
         return zip_file
 
     def _createPassJson(self):
-        return json.dumps(self, default=PassHandler)
+        """
+        Returns pass.json as UTF-8 encoded bytes, so it is encoded only once
+        for both the manifest and the zip archive. Uses orjson when it is
+        installed and falls back to the standard json module otherwise; both
+        give the types that json doesn't support to PassHandler.
+        """
+        if orjson is not None:
+            options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+                       orjson.OPT_PASSTHROUGH_DATACLASS)
+            try:
+                return orjson.dumps(self, default=PassHandler, option=options)
+            except orjson.JSONEncodeError:
+                # orjson rejects some values json supports, e.g. integers
+                # wider than 64 bits
+                pass
+        return json.dumps(self, default=PassHandler).encode('utf-8')
 
     def _createManifest(self, pass_json):
         """
         Creates the hashes for all the files included in the pass file.
+        _createZip() hashes the files while writing them, only the files
+        that are not hashed yet are read here.
         """
-        self._hashes['pass.json'] = hashlib.sha1(pass_json.encode('utf-8')).hexdigest()
-        for filename, filedata in self._files.items():
-            self._hashes[filename] = hashlib.sha1(filedata).hexdigest()
-        return json.dumps(self._hashes)
+        self._hashes['pass.json'] = hashlib.sha1(pass_json).hexdigest()
+        for name, source in self._files.items():
+            if name not in self._hashes:
+                self._hashes[name] = source.sha1()
+        # Encoded once, the same bytes are signed and written to the zip.
+        # Keys are sorted, so the same files always give the same manifest.
+        if orjson is not None:
+            return orjson.dumps(self._hashes, option=orjson.OPT_SORT_KEYS)
+        # Non-ASCII file names are written as UTF-8, like orjson does
+        return json.dumps(self._hashes, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
 
     def _get_smime(self, certificate, key, wwdr_certificate, password):
         """
-        :return: M2Crypto.SMIME.SMIME
+        :return: M2Crypto.SMIME.SMIME shared by the passes signed with these credentials
         """
-        def passwordCallback(*args, **kwds):
-            return bytes(password, encoding='ascii')
-
-        smime = SMIME.SMIME()
-
-        wwdrcert = X509.load_cert(wwdr_certificate)
-        stack = X509_Stack()
-        stack.push(wwdrcert)
-        smime.set_x509_stack(stack)
-
-        smime.load_key(key, certfile=certificate, callback=passwordCallback)
-        return smime
+        version = _files_version(certificate, key, wwdr_certificate)
+        return _cached_signer(certificate, key, wwdr_certificate, password, version)
 
     def _sign_manifest(self, manifest, certificate, key, wwdr_certificate, password):
         """
@@ -347,8 +430,8 @@ class Pass(object):
         """
         smime = self._get_smime(certificate, key, wwdr_certificate, password)
         pkcs7 = smime.sign(
-            SMIME.BIO.MemoryBuffer(bytes(manifest, encoding='utf8')),
-            flags=SMIME.PKCS7_DETACHED | SMIME.PKCS7_BINARY
+            SMIME.BIO.MemoryBuffer(manifest),
+            flags=SIGNATURE_FLAGS
         )
         return pkcs7
 
@@ -364,14 +447,48 @@ class Pass(object):
         return der.read()
 
     # Creates .pkpass (zip archive)
-    def _createZip(self, pass_json, manifest, signature, zip_file=None):
-        zf = zipfile.ZipFile(zip_file or 'pass.pkpass', 'w')
-        zf.writestr('signature', signature)
-        zf.writestr('manifest.json', manifest)
-        zf.writestr('pass.json', pass_json)
-        for filename, filedata in self._files.items():
-            zf.writestr(filename, filedata)
-        zf.close()
+    def _createZip(self, pass_json, zip_file, certificate, key, wwdr_certificate, password):
+        """
+        Writes the .pkpass to `zip_file`, a path or a writable binary file.
+        The files are hashed while they are copied into the archive, so each
+        of them is read only once; the manifest and its signature are written
+        after them.
+        """
+        with _open_output(zip_file) as output, \
+                zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+            for filename, source in self._files.items():
+                if filename.lower().endswith(STORED_EXTENSIONS):
+                    entry = _zip_entry(filename)
+                else:
+                    # ZipFile.open() has no compresslevel argument, entries
+                    # opened by name get the one of the archive
+                    entry = filename
+                with zf.open(entry, 'w') as dst:
+                    self._hashes[filename] = source.writeTo(dst)
+                _set_entry_attributes(zf.getinfo(filename))
+            manifest = self._createManifest(pass_json)
+            signature = self._createSignature(manifest, certificate, key, wwdr_certificate, password)
+            zf.writestr(_zip_entry('signature'), signature, compresslevel=COMPRESS_LEVEL)
+            zf.writestr(_zip_entry('manifest.json'), manifest, compresslevel=COMPRESS_LEVEL)
+            zf.writestr(_zip_entry('pass.json'), pass_json, compresslevel=COMPRESS_LEVEL)
+
+    # Barcode formats supported by the legacy 'barcode' key
+    _LEGACY_BARCODE_FORMATS = (BarcodeFormat.PDF417, BarcodeFormat.QR, BarcodeFormat.AZTEC)
+
+    # Optional keys, as (attribute, key) pairs, only included when set
+    _OPTIONAL_KEYS = (
+        ('relevantDate', 'relevantDate'),
+        ('backgroundColor', 'backgroundColor'),
+        ('foregroundColor', 'foregroundColor'),
+        ('labelColor', 'labelColor'),
+        ('logoText', 'logoText'),
+        ('locations', 'locations'),
+        ('ibeacons', 'beacons'),
+        ('userInfo', 'userInfo'),
+        ('associatedStoreIdentifiers', 'associatedStoreIdentifiers'),
+        ('appLaunchURL', 'appLaunchURL'),
+        ('expirationDate', 'expirationDate'),
+    )
 
     def json_dict(self):
         d = {
@@ -386,52 +503,241 @@ class Pass(object):
         }
         #barcodes have 2 fields, 'barcode' is legacy so limit it to the legacy formats, 'barcodes' supports all
         if self.barcode:
-            original_formats = [BarcodeFormat.PDF417, BarcodeFormat.QR, BarcodeFormat.AZTEC]
             legacyBarcode = self.barcode
             newBarcodes = [self.barcode.json_dict()]
-            if self.barcode.format not in original_formats:
-                legacyBarcode = Barcode(self.barcode.message, BarcodeFormat.PDF417, self.barcode.altText)
-            d.update({'barcodes': newBarcodes})
-            d.update({'barcode': legacyBarcode})
-
-        if self.relevantDate:
-            d.update({'relevantDate': self.relevantDate})
-        if self.backgroundColor:
-            d.update({'backgroundColor': self.backgroundColor})
-        if self.foregroundColor:
-            d.update({'foregroundColor': self.foregroundColor})
-        if self.labelColor:
-            d.update({'labelColor': self.labelColor})
-        if self.logoText:
-            d.update({'logoText': self.logoText})
-        if self.locations:
-            d.update({'locations': self.locations})
-        if self.ibeacons:
-            d.update({'beacons': self.ibeacons})
-        if self.userInfo:
-            d.update({'userInfo': self.userInfo})
-        if self.associatedStoreIdentifiers:
-            d.update(
-                {'associatedStoreIdentifiers': self.associatedStoreIdentifiers}
-            )
-        if self.appLaunchURL:
-            d.update({'appLaunchURL': self.appLaunchURL})
-        if self.expirationDate:
-            d.update({'expirationDate': self.expirationDate})
+            if self.barcode.format not in self._LEGACY_BARCODE_FORMATS:
+                legacyBarcode = Barcode(self.barcode.message, BarcodeFormat.PDF417,
+                                        getattr(self.barcode, 'altText', ''),
+                                        self.barcode.messageEncoding)
+            d['barcodes'] = newBarcodes
+            d['barcode'] = legacyBarcode.json_dict()
+
+        for attr, key in self._OPTIONAL_KEYS:
+            value = getattr(self, attr)
+            if value:
+                d[key] = value
         if self.voided:
-            d.update({'voided': True})
+            d['voided'] = True
         if self.webServiceURL:
-            d.update({'webServiceURL': self.webServiceURL,
-                      'authenticationToken': self.authenticationToken})
+            d['webServiceURL'] = self.webServiceURL
+            d['authenticationToken'] = self.authenticationToken
         return d
 
 
+def build_pkpass(passfile, certificate, key, wwdr_certificate, password):
+    """
+    Creates the .pkpass of a Pass and returns its contents as bytes.
+
+    Creating a pass is CPU bound (hashing, signing, compression), so many
+    passes can be created in parallel with a ProcessPoolExecutor by
+    submitting this function. Each worker process keeps its own cache of
+    credentials.
+    """
+    return passfile.create(certificate, key, wwdr_certificate, password).getvalue()
+
+
+class _FileSource(object):
+    """
+    A file included in a pass. Paths are opened when the pass is created;
+    binary file objects are read when they are added, like they always were,
+    so callers can close or reuse them afterwards.
+    """
+
+    def __init__(self, source):
+        if hasattr(source, 'read'):
+            self.path, self.data = None, source.read()
+        else:
+            self.path, self.data = source, None
+
+    @contextlib.contextmanager
+    def open(self):
+        if self.path is None:
+            yield BytesIO(self.data)
+        else:
+            with open(self.path, 'rb') as f:
+                yield f
+
+    def sha1(self):
+        with self.open() as f, _mapped(f) as view:
+            if view is None:
+                return _sha1(f)
+            return hashlib.sha1(view).hexdigest()
+
+    def writeTo(self, dst):
+        """
+        Copies the file to `dst` in chunks and returns its SHA-1 hex digest.
+        Each chunk is hashed right before it is written, while it is still
+        in the CPU cache.
+        """
+        sha1 = hashlib.sha1()
+        with self.open() as f, _mapped(f) as view:
+            if view is None:
+                buf = f.read(CHUNK_SIZE)
+                while buf:
+                    sha1.update(buf)
+                    dst.write(buf)
+                    buf = f.read(CHUNK_SIZE)
+            else:
+                for start in range(0, len(view), CHUNK_SIZE):
+                    with view[start:start + CHUNK_SIZE] as chunk:
+                        sha1.update(chunk)
+                        dst.write(chunk)
+        return sha1.hexdigest()
+
+
+def _files_version(*paths):
+    """
+    Returns the inode, size and modification time of the given files, so
+    that cached credentials are loaded again when their files are replaced.
+    """
+    return tuple((st.st_ino, st.st_size, st.st_mtime_ns) for st in map(os.stat, paths))
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_signer(certificate, key, wwdr_certificate, password, version):
+    """
+    Loads the signing certificate, its private key and the WWDR certificate
+    into an SMIME object. Parsing them is much more expensive than signing a
+    manifest, and signing doesn't modify the SMIME object, so one is cached
+    by path, password and version of the files (see _files_version) and
+    reused for each set of credentials.
+
+    :return: M2Crypto.SMIME.SMIME
+    """
+    def passwordCallback(*args, **kwds):
+        return bytes(password, encoding='ascii')
+
+    smime = SMIME.SMIME()
+
+    wwdrcert = X509.load_cert(wwdr_certificate)
+    stack = X509_Stack()
+    stack.push(wwdrcert)
+    smime.set_x509_stack(stack)
+
+    smime.pkey = EVP.load_key(key, callback=passwordCallback)
+    smime.x509 = X509.load_cert(certificate)
+    return smime
+
+
+def _zip_entry(filename):
+    """
+    Returns the ZipInfo to write a file of the .pkpass with. All entries get
+    the same fixed date, so the same pass files give the same archive
+    entries. Images are already compressed, so they are stored as is; other
+    files are deflated.
+    """
+    info = zipfile.ZipInfo(filename, date_time=ZIP_DATE_TIME)
+    _set_entry_attributes(info)
+    if filename.lower().endswith(STORED_EXTENSIONS):
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def _set_entry_attributes(info):
+    """
+    Sets the attributes of a .pkpass entry that are only written to the
+    central directory, so they can still be set once the entry is written.
+    """
+    # Made on Unix, where the external attributes hold the file permissions.
+    # The default is the platform the pass is created on (0 on Windows).
+    info.create_system = 3
+    info.external_attr = 0o644 << 16
+
+
+@contextlib.contextmanager
+def _open_output(zip_file):
+    """
+    Yields a writable binary file for the .pkpass. For paths, it is a
+    temporary file next to them, opened with a write buffer large enough for
+    most passes so it is written to disk in a few large writes. It replaces
+    the path once the .pkpass is complete; if creating the pass fails (e.g.
+    a pass file is missing), it is removed and the path is left untouched.
+    """
+    if hasattr(zip_file, 'write'):
+        yield zip_file
+        return
+    path = os.fsdecode(zip_file)
+    tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp, 'wb', buffering=OUTPUT_BUFFER_SIZE) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def _mapped(fileobj):
+    """
+    Yields a memoryview of a read-only mmap of a file object, starting at its
+    current position, so it can be hashed and written without copying it
+    into Python bytes. Yields None for files smaller than MMAP_THRESHOLD and
+    files that can't be mapped (in-memory files, pipes, etc).
+    """
+    try:
+        if os.fstat(fileobj.fileno()).st_size < MMAP_THRESHOLD:
+            mm = None
+        else:
+            mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        mm = None
+    if mm is None:
+        yield None
+        return
+    view = memoryview(mm)[fileobj.tell():]
+    try:
+        yield view
+    finally:
+        view.release()
+        mm.close()
+
+
+def _sha1(fileobj):
+    """
+    Returns the SHA-1 hex digest of a binary file object, read in chunks.
+    """
+    try:
+        # Python 3.11+
+        return hashlib.file_digest(fileobj, 'sha1').hexdigest()
+    except (AttributeError, ValueError):
+        pass
+    sha1 = hashlib.sha1()
+    buf = fileobj.read(CHUNK_SIZE)
+    while buf:
+        sha1.update(buf)
+        buf = fileobj.read(CHUNK_SIZE)
+    return sha1.hexdigest()
+
+
+# Serializers for the types that have no json_dict method
+_HANDLERS = {
+    decimal.Decimal: str,  # For Decimal latitude and logitude etc.
+    datetime.datetime: datetime.datetime.isoformat,  # W3C date, e.g. relevantDate
+    datetime.date: datetime.date.isoformat,
+    datetime.time: datetime.time.isoformat,
+    # orjson serializes these natively, do the same with json
+    uuid.UUID: str,
+    enum.Enum: lambda obj: obj.value,
+}
+
+
 def PassHandler(obj):
+    handler = _HANDLERS.get(type(obj))
+    if handler is not None:
+        return handler(obj)
     if hasattr(obj, 'json_dict'):
         return obj.json_dict()
-    else:
-        # For Decimal latitude and logitude etc.
-        if isinstance(obj, decimal.Decimal):
-            return str(obj)
-        else:
-            return obj
+    # Subclasses miss the lookup by exact type
+    for type_, handler in _HANDLERS.items():
+        if isinstance(obj, type_):
+            return handler(obj)
+    # Like json, orjson is set to pass dataclasses through to here
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    # Returning obj would make orjson call this again until its recursion
+    # limit; both json and orjson expect a TypeError instead
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
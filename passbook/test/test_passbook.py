@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
+import dataclasses
+import datetime
+import enum
 import json
+import os
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from io import BytesIO
 
 import pytest
 from M2Crypto import BIO
@@ -7,7 +16,9 @@ from M2Crypto import SMIME
 from M2Crypto import X509
 from path import Path
 
-from passbook.models import Barcode, BarcodeFormat, CurrencyField, Pass, StoreCard
+from passbook import models
+from passbook.models import (Barcode, BarcodeFormat, BoardingPass, CurrencyField, Location, Pass,
+                             StoreCard, TransitType)
 
 cwd = Path(__file__).parent
 
@@ -17,6 +28,31 @@ key = cwd / 'certificates' / 'private.key'
 password_file = cwd / 'certificates' / 'password.txt'
 
 
+def read_password():
+    """
+    Returns the password of the private key, stored in the file indicated
+    above, or an empty password when there is no such file.
+    """
+    try:
+        with open(password_file) as file_:
+            return file_.read().strip()
+    except IOError:
+        return ''
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def json_backend(request, monkeypatch):
+    """
+    Runs a test once with orjson, when it is installed, and once with the
+    json module, so that both give the same pass.json and manifest.
+    """
+    if request.param == 'json':
+        monkeypatch.setattr(models, 'orjson', None)
+    elif models.orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
 def create_shell_pass(barcodeFormat=BarcodeFormat.CODE128):
     cardInfo = StoreCard()
     cardInfo.addPrimaryField('name', u'Jähn Doe', 'Name')
@@ -88,6 +124,47 @@ def test_auxiliary_fields():
     assert pass_json['storeCard']['auxiliaryFields'][0]['label'] == 'Famous Inc.'
 
 
+def test_add_field():
+    passfile = create_shell_pass()
+    passfile.passInformation.addField('headerFields', 'header', 'VIP Store Card')
+    pass_json = passfile.json_dict()
+    assert list(pass_json['storeCard']) == ['headerFields', 'primaryFields']
+    assert pass_json['storeCard']['headerFields'][0]['key'] == 'header'
+    assert pass_json['storeCard']['headerFields'][0]['value'] == 'VIP Store Card'
+    assert pass_json['storeCard']['headerFields'][0]['label'] == ''
+
+
+def test_field_groups_of_subclass():
+    class ExtraCard(StoreCard):
+        _FIELD_GROUPS = StoreCard._FIELD_GROUPS + ('extraFields',)
+
+        def __init__(self):
+            super().__init__()
+            self.extraFields = []
+
+    cardInfo = ExtraCard()
+    cardInfo.addField('extraFields', 'extra', 'Extra value')
+    cardInfo.addPrimaryField('name', 'John Doe', 'Name')
+    info_json = cardInfo.json_dict()
+    assert list(info_json) == ['primaryFields', 'extraFields']
+    assert info_json['extraFields'][0]['key'] == 'extra'
+
+
+def test_field_groups_of_boarding_pass_subclass():
+    class ExtraBoardingPass(BoardingPass):
+        _FIELD_GROUPS = BoardingPass._FIELD_GROUPS + ('extraFields',)
+
+        def __init__(self):
+            super().__init__(TransitType.TRAIN)
+            self.extraFields = []
+
+    boardingPass = ExtraBoardingPass()
+    boardingPass.addField('extraFields', 'extra', 'Extra value')
+    info_json = boardingPass.json_dict()
+    assert info_json['transitType'] == TransitType.TRAIN
+    assert info_json['extraFields'][0]['key'] == 'extra'
+
+
 def test_code128_pass():
     """
     This test is to create a pass with a new code128 format,
@@ -100,6 +177,67 @@ def test_code128_pass():
     assert thawedJson['barcode']['format'] == BarcodeFormat.PDF417
     assert thawedJson['barcodes'][0]['format'] == BarcodeFormat.CODE128
 
+    pass_json = passfile.json_dict()
+    assert pass_json['barcode']['format'] == BarcodeFormat.PDF417
+    assert pass_json['barcode']['altText'] == 'alternate text'
+
+
+def test_pass_json_with_decimal(json_backend):
+    passfile = create_shell_pass()
+    passfile.locations = [Location(-34.6, -58.4)]
+    passfile.userInfo = {'balance': Decimal('22.50')}
+    pass_json = json.loads(passfile._createPassJson())
+    assert pass_json['locations'][0]['latitude'] == -34.6
+    assert pass_json['userInfo']['balance'] == '22.50'
+
+
+def test_pass_json_with_big_integer(json_backend):
+    passfile = create_shell_pass()
+    passfile.userInfo = {'cardNumber': 98765432109876543210}
+    assert json.loads(passfile._createPassJson())['userInfo']['cardNumber'] == 98765432109876543210
+
+
+def test_pass_json_with_unsupported_type(json_backend):
+    passfile = create_shell_pass()
+    passfile.userInfo = {'customer': object()}
+    with pytest.raises(TypeError, match='not JSON serializable'):
+        passfile._createPassJson()
+
+
+def test_pass_json_with_dataclass(json_backend):
+    @dataclasses.dataclass
+    class Customer:
+        name: str
+        points: int
+
+    passfile = create_shell_pass()
+    passfile.userInfo = {'customer': Customer('John Doe', 10)}
+    expected = {'name': 'John Doe', 'points': 10}
+    assert json.loads(passfile._createPassJson())['userInfo']['customer'] == expected
+
+
+def test_pass_json_with_dates_uuids_and_enums(json_backend):
+    class Level(enum.Enum):
+        GOLD = 'gold'
+
+    passfile = create_shell_pass()
+    passfile.relevantDate = datetime.datetime(2020, 1, 2, 10, 30, tzinfo=datetime.timezone.utc)
+    passfile.expirationDate = datetime.date(2020, 12, 31)
+    passfile.userInfo = {'id': uuid.UUID(int=1), 'level': Level.GOLD}
+    pass_json = json.loads(passfile._createPassJson())
+    assert pass_json['relevantDate'] == '2020-01-02T10:30:00+00:00'
+    assert pass_json['expirationDate'] == '2020-12-31'
+    assert pass_json['userInfo'] == {'id': '00000000-0000-0000-0000-000000000001', 'level': 'gold'}
+
+
+def test_pass_json_with_decimal_subclass(json_backend):
+    class Points(Decimal):
+        pass
+
+    passfile = create_shell_pass()
+    passfile.userInfo = {'points': Points('10.5')}
+    assert json.loads(passfile._createPassJson())['userInfo']['points'] == '10.5'
+
 
 def test_pdf_417_pass():
     """
@@ -113,6 +251,28 @@ def test_pdf_417_pass():
     assert thawedJson['barcodes'][0]['format'] == BarcodeFormat.PDF417
 
 
+def test_code128_pass_without_alt_text():
+    passfile = create_shell_pass()
+    passfile.barcode = Barcode('test barcode', BarcodeFormat.CODE128, messageEncoding='utf-8')
+    thawedJson = json.loads(passfile._createPassJson())
+    assert thawedJson['barcode'] == {
+        'format': BarcodeFormat.PDF417,
+        'message': 'test barcode',
+        'messageEncoding': 'utf-8',
+    }
+
+
+def test_optional_keys():
+    passfile = create_shell_pass()
+    passfile.backgroundColor = 'rgb(255, 255, 255)'
+    passfile.ibeacons = [{'proximityUUID': 'uuid'}]
+    pass_json = passfile.json_dict()
+    assert pass_json['backgroundColor'] == 'rgb(255, 255, 255)'
+    assert pass_json['beacons'] == [{'proximityUUID': 'uuid'}]
+    assert 'foregroundColor' not in pass_json
+    assert 'ibeacons' not in pass_json
+
+
 def test_files():
     passfile = create_shell_pass()
     passfile.addFile('icon.png', open(cwd / 'static/white_square.png', 'rb'))
@@ -132,6 +292,72 @@ def test_files():
     assert '170eed23019542b0a2890a0bf753effea0db181a' == manifest['logo.png']
 
 
+def test_files_from_path():
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', cwd / 'static' / 'white_square.png')
+    assert 'icon.png' in passfile._files
+
+    manifest_json = passfile._createManifest(passfile._createPassJson())
+    manifest = json.loads(manifest_json)
+    assert '170eed23019542b0a2890a0bf753effea0db181a' == manifest['icon.png']
+
+
+def test_large_files_from_path_are_mapped(monkeypatch):
+    monkeypatch.setattr(models, 'MMAP_THRESHOLD', 1)
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', cwd / 'static' / 'white_square.png')
+    out = BytesIO()
+    assert passfile._files['icon.png'].writeTo(out) == '170eed23019542b0a2890a0bf753effea0db181a'
+    assert out.getvalue() == (cwd / 'static' / 'white_square.png').read_bytes()
+
+    manifest = json.loads(passfile._createManifest(passfile._createPassJson()))
+    assert '170eed23019542b0a2890a0bf753effea0db181a' == manifest['icon.png']
+
+
+def test_files_are_read_when_added():
+    password = read_password()
+
+    passfile = create_shell_pass()
+    with open(cwd / 'static' / 'white_square.png', 'rb') as f:
+        passfile.addFile('icon.png', f)
+    data = BytesIO(b'abc')
+    passfile.addFile('data.txt', data)
+    data.seek(0)
+    data.write(b'zzz')
+
+    zip_file = passfile.create(certificate, key, wwdr_certificate, password)
+    with zipfile.ZipFile(zip_file) as zf:
+        assert zf.read('icon.png') == (cwd / 'static' / 'white_square.png').read_bytes()
+        assert zf.read('data.txt') == b'abc'
+        manifest = json.loads(zf.read('manifest.json'))
+    assert 'a9993e364706816aba3e25717850c26c9cd0d89d' == manifest['data.txt']
+
+
+def test_manifest_is_canonical(json_backend):
+    passfile = create_shell_pass()
+    passfile.addFile('logo.png', cwd / 'static' / 'white_square.png')
+    passfile.addFile('icon.png', cwd / 'static' / 'white_square.png')
+    passfile.addFile(u'café.png', cwd / 'static' / 'white_square.png')
+    assert passfile._createManifest(b'{}') == (
+        u'{"café.png":"170eed23019542b0a2890a0bf753effea0db181a",'.encode('utf-8') +
+        b'"icon.png":"170eed23019542b0a2890a0bf753effea0db181a",'
+        b'"logo.png":"170eed23019542b0a2890a0bf753effea0db181a",'
+        b'"pass.json":"bf21a9e8fbc5a3846fb05b4fa0859e0917b2202f"}'
+    )
+
+
+def test_files_are_not_shared_between_passes():
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', cwd / 'static' / 'white_square.png')
+    passfile._createManifest(passfile._createPassJson())
+
+    other = create_shell_pass()
+    assert other._files == {}
+    assert other._hashes == {}
+    manifest = json.loads(other._createManifest(other._createPassJson()))
+    assert list(manifest) == ['pass.json']
+
+
 def test_signing():
     """
     This test can only run locally if you provide your personal Apple Wallet
@@ -170,10 +396,10 @@ def test_signing():
 
     smime.set_x509_store(store)
 
-    data_bio = BIO.MemoryBuffer(bytes(manifest_json, encoding='utf8'))
+    data_bio = BIO.MemoryBuffer(manifest_json)
 
     # PKCS7_NOVERIFY = do not verify the signers certificate of a signed message.
-    assert smime.verify(signature, data_bio, flags=SMIME.PKCS7_NOVERIFY) == bytes(manifest_json, encoding='utf8')
+    assert smime.verify(signature, data_bio, flags=SMIME.PKCS7_NOVERIFY) == manifest_json
 
     tampered_manifest = bytes('{"pass.json": "foobar"}', encoding='utf8')
     data_bio = BIO.MemoryBuffer(tampered_manifest)
@@ -200,6 +426,103 @@ def test_passbook_creation():
     passfile.create(certificate, key, wwdr_certificate, password)
 
 
+def test_passbook_creation_to_path(tmp_path):
+    password = read_password()
+
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', cwd / 'static' / 'white_square.png')
+    passfile.addFile('pass.strings', BytesIO(b'"name" = "Name";'))
+    pkpass = str(tmp_path / 'test.pkpass')
+    passfile.create(certificate, key, wwdr_certificate, password, pkpass)
+
+    with zipfile.ZipFile(pkpass) as zf:
+        assert sorted(zf.namelist()) == ['icon.png', 'manifest.json', 'pass.json', 'pass.strings', 'signature']
+        assert zf.getinfo('icon.png').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('pass.strings').compress_type == zipfile.ZIP_DEFLATED
+        assert all(info.create_system == 3 for info in zf.infolist())
+        assert all(info.external_attr == 0o644 << 16 for info in zf.infolist())
+        assert zf.getinfo('pass.json').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo('manifest.json').compress_type == zipfile.ZIP_DEFLATED
+        assert all(info.date_time == (1980, 1, 1, 0, 0, 0) for info in zf.infolist())
+        assert zf.testzip() is None
+        assert zf.read('icon.png') == (cwd / 'static' / 'white_square.png').read_bytes()
+        manifest = json.loads(zf.read('manifest.json'))
+    assert '170eed23019542b0a2890a0bf753effea0db181a' == manifest['icon.png']
+
+
+def test_failed_creation_to_path_leaves_no_output(tmp_path):
+    password = read_password()
+
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', str(tmp_path / 'missing.png'))
+    pkpass = tmp_path / 'test.pkpass'
+    with pytest.raises(FileNotFoundError):
+        passfile.create(certificate, key, wwdr_certificate, password, str(pkpass))
+    assert list(tmp_path.iterdir()) == []
+
+    pkpass.write_bytes(b'previous pass')
+    with pytest.raises(FileNotFoundError):
+        passfile.create(certificate, key, wwdr_certificate, password, str(pkpass))
+    assert list(tmp_path.iterdir()) == [pkpass]
+    assert pkpass.read_bytes() == b'previous pass'
+
+
+def test_passbook_creation_uses_create_signature():
+    password = read_password()
+
+    class UnsignedPass(Pass):
+        def _createSignature(self, manifest, certificate, key, wwdr_certificate, password):
+            return b'signature'
+
+    passfile = create_shell_pass()
+    passfile.__class__ = UnsignedPass
+    with zipfile.ZipFile(passfile.create(certificate, key, wwdr_certificate, password)) as zf:
+        assert zf.read('signature') == b'signature'
+
+
+def test_signing_material_is_cached():
+    password = read_password()
+
+    models._cached_signer.cache_clear()
+    passfile = create_shell_pass()
+    passfile.create(certificate, key, wwdr_certificate, password)
+    passfile.create(certificate, key, wwdr_certificate, password)
+
+    cache_info = models._cached_signer.cache_info()
+    assert cache_info.misses == 1
+    assert cache_info.hits > 0
+
+
+def test_signing_material_is_reloaded_when_replaced(tmp_path):
+    password = read_password()
+
+    key_copy = tmp_path / 'private.key'
+    key_copy.write_bytes(key.read_bytes())
+    models._cached_signer.cache_clear()
+    passfile = create_shell_pass()
+    passfile.create(certificate, str(key_copy), wwdr_certificate, password)
+
+    stat = key_copy.stat()
+    os.utime(str(key_copy), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    passfile.create(certificate, str(key_copy), wwdr_certificate, password)
+    assert models._cached_signer.cache_info().misses == 2
+
+
+def test_build_pkpass_in_process_pool():
+    password = read_password()
+
+    passfile = create_shell_pass()
+    passfile.addFile('icon.png', str(cwd / 'static' / 'white_square.png'))
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            models.build_pkpass, passfile, str(certificate), str(key), str(wwdr_certificate), password)
+        pkpass = future.result()
+
+    with zipfile.ZipFile(BytesIO(pkpass)) as zf:
+        assert sorted(zf.namelist()) == ['icon.png', 'manifest.json', 'pass.json', 'signature']
+        assert zf.testzip() is None
+
+
 def test_currency_field_has_no_numberstyle():
     balance_field = CurrencyField(
         'balance',
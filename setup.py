@@ -15,16 +15,23 @@ setup(
 
     download_url='http://pypi.python.org/packages/source/P/Passbook/Passbook-%s.tar.gz' % version,
 
+    # Writing entries with ZipFile.open() needs Python 3.6, and passing a
+    # compresslevel to zipfile 3.7
+    python_requires='>=3.7',
+
     install_requires=[
         'M2Crypto >= 0.28.2',
     ],
 
+    extras_require={
+        # OPT_PASSTHROUGH_DATACLASS is only available since orjson 3.1
+        'orjson': ['orjson >= 3.1.0'],
+    },
+
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Other Environment',
         'Intended Audience :: Developers',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3 :: Only',